@@ -1,8 +1,11 @@
 import os
 import sys
 import threading
+import queue
 import requests
+from requests.adapters import HTTPAdapter
 import pyautogui
+import mss
 from PIL import Image
 import pystray
 from io import BytesIO
@@ -10,6 +13,8 @@ import tkinter as tk
 import time
 import pyperclip
 import ctypes
+from multiprocessing import shared_memory
+from urllib.parse import urlparse
 
 # Hide console window immediately
 def hide_console():
@@ -20,16 +25,235 @@ def hide_console():
 SERVER_URL = "http://127.0.0.1:5000/solve"
 # SERVER_URL = "https://test.420013.xyz/solve"
 ICON_PATH = "icon.png"
+# Screenshot encoding for upload; lossy WebP in fast mode is far cheaper than PNG
+# and OCR copes fine with it (Pillow on the server decodes either).
+# 'RAW' skips compression and posts the pixel buffer as-is (fast links only).
+UPLOAD_FORMAT = 'WEBP'
+UPLOAD_OPTIONS = {'quality': 80, 'method': 0}
+UPLOAD_MIMETYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+# When the server runs on this machine, pass the raw screenshot through shared
+# memory instead of encoding and uploading it. Set USE_SHARED_MEMORY=0 when
+# "localhost" is a different OS namespace (WSL/Docker server, ssh tunnel).
+USE_SHARED_MEMORY = (urlparse(SERVER_URL).hostname in ('127.0.0.1', 'localhost')
+                     and os.getenv("USE_SHARED_MEMORY", "1") != "0")
+# Optional screen region (x, y, width, height) to capture instead of the whole screen,
+# e.g. QUESTION_ROI=0,150,1920,800 to skip the taskbar and browser chrome
+def parse_roi(value):
+    """Parses "x,y,width,height" into a tuple, or returns None if unset or invalid."""
+    if not value:
+        return None
+    try:
+        roi = tuple(int(v) for v in value.split(','))
+    except ValueError:
+        roi = ()
+    if len(roi) != 4 or roi[2] <= 0 or roi[3] <= 0:
+        print(f"Ignoring invalid QUESTION_ROI {value!r}, expected x,y,width,height with positive size")
+        return None
+    return roi
+
+QUESTION_ROI = parse_roi(os.getenv("QUESTION_ROI"))
+# Seconds to wait for the server; leaves room for OCR plus the Gemini fallback
+REQUEST_TIMEOUT = 30
 
 # Global state for debug window
 debug_window = None
 
+# Screen capture and upload buffer are reused across clicks; the lock keeps
+# overlapping clicks from sharing them mid-request
+_capture = None
+_upload_buf = BytesIO()
+_capture_lock = threading.Lock()
+_shm = None
+# Cleared for the rest of the session if the server can't read our shared memory
+_use_shared_memory = USE_SHARED_MEMORY
+
+# Persistent HTTP session so every click reuses the same keep-alive connection
+_session = requests.Session()
+_session.headers['Connection'] = 'keep-alive'
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+class Win32Capture:
+    """Grabs the primary screen with GDI BitBlt into a buffer allocated once."""
+
+    SRCCOPY = 0x00CC0020
+    DIB_RGB_COLORS = 0
+
+    def __init__(self):
+        from ctypes import wintypes
+
+        class BITMAPINFOHEADER(ctypes.Structure):
+            _fields_ = [
+                ('biSize', wintypes.DWORD), ('biWidth', wintypes.LONG), ('biHeight', wintypes.LONG),
+                ('biPlanes', wintypes.WORD), ('biBitCount', wintypes.WORD), ('biCompression', wintypes.DWORD),
+                ('biSizeImage', wintypes.DWORD), ('biXPelsPerMeter', wintypes.LONG), ('biYPelsPerMeter', wintypes.LONG),
+                ('biClrUsed', wintypes.DWORD), ('biClrImportant', wintypes.DWORD),
+            ]
+
+        self.user32 = ctypes.windll.user32
+        self.gdi32 = ctypes.windll.gdi32
+        # Handles are pointer sized, don't let ctypes truncate them to int
+        self.user32.GetDC.restype = wintypes.HDC
+        self.user32.GetDC.argtypes = [wintypes.HWND]
+        self.user32.ReleaseDC.argtypes = [wintypes.HWND, wintypes.HDC]
+        self.gdi32.CreateCompatibleDC.restype = wintypes.HDC
+        self.gdi32.CreateCompatibleDC.argtypes = [wintypes.HDC]
+        self.gdi32.CreateCompatibleBitmap.restype = wintypes.HBITMAP
+        self.gdi32.CreateCompatibleBitmap.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int]
+        self.gdi32.SelectObject.restype = wintypes.HGDIOBJ
+        self.gdi32.SelectObject.argtypes = [wintypes.HDC, wintypes.HGDIOBJ]
+        self.gdi32.BitBlt.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                      wintypes.HDC, ctypes.c_int, ctypes.c_int, wintypes.DWORD]
+        self.gdi32.GetDIBits.argtypes = [wintypes.HDC, wintypes.HBITMAP, wintypes.UINT, wintypes.UINT,
+                                         ctypes.c_void_p, ctypes.c_void_p, wintypes.UINT]
+        self.gdi32.DeleteObject.argtypes = [wintypes.HGDIOBJ]
+        self.gdi32.DeleteDC.argtypes = [wintypes.HDC]
+
+        # pyautogui already made the process DPI aware, so these are physical pixels
+        self.width = self.user32.GetSystemMetrics(0)
+        self.height = self.user32.GetSystemMetrics(1)
+        self._buf = (ctypes.c_ubyte * (self.width * self.height * 4))()
+
+        self._bmi = BITMAPINFOHEADER()
+        self._bmi.biSize = ctypes.sizeof(BITMAPINFOHEADER)
+        self._bmi.biWidth = self.width
+        self._bmi.biHeight = -self.height  # negative = top-down rows
+        self._bmi.biPlanes = 1
+        self._bmi.biBitCount = 32
+        self._bmi.biCompression = 0  # BI_RGB
+
+    def grab(self, region=None):
+        """Returns the screen (or the (x, y, width, height) region of it) as an RGB image
+        together with the (left, top) screen position of its top-left pixel."""
+        left, top, width, height = region or (0, 0, self.width, self.height)
+        # The buffer is sized for the full screen, so capture only the part of the
+        # region that lies on it
+        right = min(left + width, self.width)
+        bottom = min(top + height, self.height)
+        left, top = max(left, 0), max(top, 0)
+        width, height = right - left, bottom - top
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Capture region {region} lies outside the primary screen")
+        self._bmi.biWidth = width
+        self._bmi.biHeight = -height
+
+        hdc = self.user32.GetDC(None)
+        memdc = self.gdi32.CreateCompatibleDC(hdc)
+        bmp = self.gdi32.CreateCompatibleBitmap(hdc, width, height)
+        old = self.gdi32.SelectObject(memdc, bmp)
+        try:
+            self.gdi32.BitBlt(memdc, 0, 0, width, height, hdc, left, top, self.SRCCOPY)
+            self.gdi32.GetDIBits(memdc, bmp, 0, height, self._buf, ctypes.byref(self._bmi), self.DIB_RGB_COLORS)
+        finally:
+            self.gdi32.SelectObject(memdc, old)
+            self.gdi32.DeleteObject(bmp)
+            self.gdi32.DeleteDC(memdc)
+            self.user32.ReleaseDC(None, hdc)
+        # BGRX unpacking drops the unused fourth byte while converting to RGB
+        return Image.frombuffer('RGB', (width, height), self._buf, 'raw', 'BGRX', 0, 1), (left, top)
+
+class MssCapture:
+    """Grabs the primary monitor with mss (non-Windows clients)."""
+
+    def __init__(self):
+        self._sct = mss.mss()
+
+    def grab(self, region=None):
+        """Returns the screen (or the (x, y, width, height) region of it) as an RGB image
+        together with the (left, top) screen position of its top-left pixel."""
+        # Primary monitor; pyautogui clicks in virtual screen coordinates, so the origin
+        # returned includes the monitor's own offset
+        monitor = self._sct.monitors[1]
+        left, top, width, height = region or (0, 0, monitor['width'], monitor['height'])
+        # Capture only the part of the region that lies on the monitor
+        right = min(left + width, monitor['width'])
+        bottom = min(top + height, monitor['height'])
+        left, top = max(left, 0), max(top, 0)
+        if right <= left or bottom <= top:
+            raise ValueError(f"Capture region {region} lies outside the primary screen")
+        area = {'left': monitor['left'] + left, 'top': monitor['top'] + top,
+                'width': right - left, 'height': bottom - top}
+        raw = self._sct.grab(area)
+        return Image.frombuffer('RGB', raw.size, raw.rgb, 'raw', 'RGB', 0, 1), (area['left'], area['top'])
+
+def grab_screen(region=None):
+    """Captures the primary screen (or a region of it), creating the platform's capture
+    backend on first use. Returns the image and the screen position of its origin."""
+    global _capture
+    if _capture is None:
+        _capture = Win32Capture() if os.name == 'nt' else MssCapture()
+    return _capture.grab(region)
+
 def log(message):
     """Logs message to debug window if open, otherwise print (which is hidden in .pyw)."""
     # print(message) # Optional: print to stdout if checking logs later
     if debug_window:
         debug_window.log(message)
 
+def get_shared_buffer(size):
+    """Returns a shared memory block of at least size bytes, reusing the previous one."""
+    global _shm
+    if _shm is None or _shm.size < size:
+        release_shared_buffer()
+        _shm = shared_memory.SharedMemory(create=True, size=size)
+    return _shm
+
+def release_shared_buffer():
+    global _shm
+    if _shm is not None:
+        _shm.close()
+        _shm.unlink()
+        _shm = None
+
+def encode_raw(image):
+    """Returns the raw pixel bytes of image in a single encoder call.
+
+    Image.tobytes() encodes in small blocks and joins them; sizing the buffer to the
+    whole image avoids the chunking and the extra copy.
+    """
+    image.load()
+    encoder = Image._getencoder(image.mode, 'raw', image.mode)
+    encoder.setimage(image.im, (0, 0) + image.size)
+    _, errcode, data = encoder.encode(image.width * image.height * len(image.getbands()))
+    if errcode <= 0:
+        # Encoder didn't finish in one pass, let Pillow handle it
+        return image.tobytes()
+    return data
+
+def disable_shared_memory():
+    """Switches this session over to regular uploads."""
+    global _use_shared_memory
+    _use_shared_memory = False
+    release_shared_buffer()
+
+def upload_screenshot(screenshot, region_headers):
+    """Encodes the screenshot as UPLOAD_FORMAT and posts it to the server."""
+    width, height = screenshot.size
+    if UPLOAD_FORMAT == 'RAW':
+        # 2./3. Send the uncompressed pixels with their geometry in headers
+        log(f"Sending to {SERVER_URL}...")
+        headers = {
+            **region_headers,
+            'Content-Type': 'application/octet-stream',
+            'X-Image-Width': str(width),
+            'X-Image-Height': str(height),
+            'X-Image-Mode': screenshot.mode,
+        }
+        return _session.post(SERVER_URL, data=encode_raw(screenshot), headers=headers, timeout=REQUEST_TIMEOUT)
+
+    # 2. Prepare file for upload
+    _upload_buf.seek(0)
+    _upload_buf.truncate()
+    screenshot.save(_upload_buf, format=UPLOAD_FORMAT, **UPLOAD_OPTIONS)
+    _upload_buf.seek(0)
+    
+    # 3. Send to Server
+    log(f"Sending to {SERVER_URL}...")
+    filename = f"screenshot.{UPLOAD_FORMAT.lower()}"
+    files = {'image': (filename, _upload_buf, UPLOAD_MIMETYPES[UPLOAD_FORMAT])}
+    return _session.post(SERVER_URL, files=files, headers=region_headers, timeout=REQUEST_TIMEOUT)
+
 def capture_and_solve(icon):
     """Captures screenshot, sends to server, and clicks coordinates."""
     log("Capturing screenshot...")
@@ -38,18 +262,34 @@ def capture_and_solve(icon):
         pyautogui.press('esc')
         time.sleep(0.2) 
 
-        # 1. Capture Screen
-        screenshot = pyautogui.screenshot()
-        
-        # 2. Prepare file for upload
-        img_byte_arr = BytesIO()
-        screenshot.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        
-        # 3. Send to Server
-        log(f"Sending to {SERVER_URL}...")
-        files = {'image': ('screenshot.png', img_byte_arr, 'image/png')}
-        response = requests.post(SERVER_URL, files=files)
+        with _capture_lock:
+            # 1. Capture Screen (only the configured region, if any)
+            screenshot, (origin_x, origin_y) = grab_screen(QUESTION_ROI)
+            width, height = screenshot.size
+            # The server adds the captured area's origin back onto the click coordinates
+            region_headers = {
+                'X-Region-Left': str(origin_x),
+                'X-Region-Top': str(origin_y),
+            }
+
+            response = None
+            if _use_shared_memory:
+                # 2./3. Copy raw RGB into shared memory and send only its name
+                rgb = encode_raw(screenshot)
+                shm = get_shared_buffer(len(rgb))
+                shm.buf[:len(rgb)] = rgb
+                log(f"Sending to {SERVER_URL} via shared memory...")
+                payload = {'shm': shm.name, 'w': width, 'h': height}
+                response = _session.post(SERVER_URL, json=payload, headers=region_headers, timeout=REQUEST_TIMEOUT)
+                if response.status_code in (400, 500):
+                    # The server can't read our block (other namespace, unlinked segment, ...);
+                    # stop using shared memory and upload the screenshot instead
+                    log("Shared memory unavailable, falling back to upload.")
+                    disable_shared_memory()
+                    response = None
+
+            if response is None:
+                response = upload_screenshot(screenshot, region_headers)
         
         if response.status_code == 200:
             coords_list = response.json()
@@ -100,10 +340,18 @@ def open_debug_window(icon, item):
 
 def exit_app(icon, item):
     """Stops the application."""
+    with _capture_lock:
+        release_shared_buffer()
     icon.stop()
     sys.exit()
 
 class DebugWindow:
+    # Keep at most this many lines, trimming the oldest in chunks
+    MAX_LINES = 500
+    TRIM_LINES = 100
+    # How often (ms) the Tk thread picks up queued log lines
+    DRAIN_INTERVAL = 50
+
     def __init__(self, master):
         self.master = master
         master.title("MicrosoftEdge Debug")
@@ -111,10 +359,31 @@ class DebugWindow:
         
         self.text_area = tk.Text(master)
         self.text_area.pack(expand=True, fill='both')
+
+        # Worker threads only enqueue; all widget access happens on the Tk thread
+        self.queue = queue.Queue()
+        master.after(self.DRAIN_INTERVAL, self._drain)
         
     def log(self, text):
-        self.text_area.insert(tk.END, text + "\n")
-        self.text_area.see(tk.END)
+        self.queue.put(text)
+
+    def _drain(self):
+        wrote = False
+        while True:
+            try:
+                text = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.text_area.insert(tk.END, text + "\n")
+            wrote = True
+
+        if wrote:
+            line_count = int(self.text_area.index('end-1c').split('.')[0])
+            if line_count > self.MAX_LINES:
+                self.text_area.delete('1.0', f'{self.TRIM_LINES + 1}.0')
+            self.text_area.see(tk.END)
+
+        self.master.after(self.DRAIN_INTERVAL, self._drain)
 
 def clear_action(icon, item):
     """Simulates 'Open' action: Presses ESC and clears clipboard."""
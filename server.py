@@ -1,22 +1,45 @@
 import os
 import json
 import logging
+import hashlib
+import ipaddress
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
 from flask import Flask, request, jsonify
-from PIL import Image
+from PIL import Image, ImageOps
+import numpy as np
 import pytesseract
-from thefuzz import process, fuzz
+from rapidfuzz import process, fuzz, utils
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+# Numba is listed in requirements.txt; if it's missing anyway the kernels below
+# simply run as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Load environment variables
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Seconds to wait for a Gemini answer before giving up on the fallback
+GEMINI_TIMEOUT = 10
+# Created once and reused by every fallback request
+_GEMINI_MODEL = None
 if GOOGLE_API_KEY:
     try:
         genai.configure(api_key=GOOGLE_API_KEY)
+        _GEMINI_MODEL = genai.GenerativeModel('gemini-2.0-flash')
     except Exception as e:
          logging.error(f"Failed to configure Gemini: {e}")
 else:
@@ -38,6 +61,41 @@ else:
         # Fallback to local user appdata or just warn
         logging.warning(f"Tesseract not found in {tesseract_path} or {tesseract_path_x86}. Hoping it's in PATH.")
 
+# Use local tessdata config via environment variable
+local_tessdata = os.path.join(os.getcwd(), "tessdata")
+if os.path.exists(os.path.join(local_tessdata, "ces.traineddata")):
+    os.environ["TESSDATA_PREFIX"] = local_tessdata
+else:
+    local_tessdata = None
+
+# Tesseract's OpenMP threading only adds overhead when recognizing a single image
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+# OEM 1 = LSTM engine only, PSM 6 = treat the screenshot as one uniform block of text
+TESSERACT_CONFIG = '--oem 1 --psm 6'
+# Screenshots wider than this are downscaled by OCR_DOWNSCALE before OCR (e.g. 4K screens)
+OCR_DOWNSCALE_WIDTH = 2560
+OCR_DOWNSCALE = 2
+# Grey level (after autocontrast) above which a pixel becomes white when binarizing
+OCR_THRESHOLD = 128
+
+# Prefer an in-process Tesseract via tesserocr: the model is loaded once and reused,
+# instead of pytesseract spawning tesseract.exe and parsing TSV for every request
+try:
+    from tesserocr import PyTessBaseAPI, RIL, OEM, PSM, iterate_level
+    _tess_kwargs = {'lang': 'ces', 'oem': OEM.LSTM_ONLY, 'psm': PSM.SINGLE_BLOCK}
+    if local_tessdata:
+        _tess_kwargs['path'] = local_tessdata
+    TESS_API = PyTessBaseAPI(**_tess_kwargs)
+    logging.info("Using in-process tesserocr for OCR.")
+except Exception as e:
+    TESS_API = None
+    logging.info(f"tesserocr not available ({e}), falling back to pytesseract.")
+# The Tesseract API object is not thread safe and Flask serves requests on threads
+_tess_lock = threading.Lock()
+
+# Minimum fuzz.ratio an OCR window needs to count as the answer's location
+ANSWER_MATCH_THRESHOLD = 65
+
 DATA_FILE = 'answers.json'
 
 def load_data():
@@ -52,15 +110,153 @@ def load_data():
 
 QUESTIONS_DB = load_data()
 
+# Normalize question texts once at load time so /solve doesn't redo it per request
+QUESTION_TEXTS_PROCESSED = [utils.default_process(q['text']) for q in QUESTIONS_DB]
+
+# Cache of recent results keyed by screenshot hash, so repeated clicks on an
+# unchanged screen skip OCR and matching entirely
+RESULT_CACHE_SIZE = 32
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def image_cache_key(image):
+    """Returns a hash of the exact pixel content of the image."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}:{image.width}x{image.height}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+def get_cached_result(key):
+    with _result_cache_lock:
+        result = _result_cache.get(key)
+        if result is not None:
+            _result_cache.move_to_end(key)
+        return result
+
+def store_cached_result(key, result):
+    with _result_cache_lock:
+        _result_cache[key] = result
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+def is_local_request():
+    """True if the request comes straight from this machine (not via a proxy)."""
+    # A reverse proxy on this host would otherwise make remote callers look local
+    if 'X-Forwarded-For' in request.headers or 'Forwarded' in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+def image_from_shared_memory(payload):
+    """Reads a raw RGB screenshot that a local client placed in shared memory."""
+    width, height = int(payload['w']), int(payload['h'])
+    try:
+        # Don't let this process's resource tracker unlink the client's block (3.13+)
+        shm = shared_memory.SharedMemory(name=payload['shm'], track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=payload['shm'])
+        if os.name == 'posix':
+            # Older Pythons register every attached block and unlink it when the server
+            # exits, which would pull the segment out from under a still-running client
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        view = shm.buf[:width * height * 3]
+        try:
+            return Image.frombytes('RGB', (width, height), view)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+def preprocess_for_ocr(image):
+    """Greyscales, downscales and binarizes the screenshot for Tesseract.
+
+    Returns the processed image and the factor OCR coordinates must be multiplied by
+    to map back onto the original screenshot.
+    """
+    gray = image.convert('L')
+    scale = 1
+    if gray.width > OCR_DOWNSCALE_WIDTH:
+        scale = OCR_DOWNSCALE
+        gray = gray.resize((gray.width // scale, gray.height // scale), Image.BILINEAR)
+    gray = ImageOps.autocontrast(gray)
+    binary = gray.point(lambda p: 255 if p > OCR_THRESHOLD else 0, mode='1')
+    return binary, scale
+
+def ocr_words(ocr_image, scale):
+    """Runs OCR and returns the recognized words with their boxes in screen coordinates.
+
+    The result is structure-of-arrays: a list of word texts plus parallel NumPy arrays
+    (xs, ys, ws, hs) holding each word's box.
+    """
+    if TESS_API is not None:
+        texts, boxes = [], []
+        with _tess_lock:
+            TESS_API.SetImage(ocr_image)
+            TESS_API.Recognize()
+            ri = TESS_API.GetIterator()
+            for r in iterate_level(ri, RIL.WORD):
+                text = (r.GetUTF8Text(RIL.WORD) or '').strip()
+                box = r.BoundingBox(RIL.WORD)
+                if text and box and r.Confidence(RIL.WORD) > 0:
+                    texts.append(text)
+                    boxes.append(box)
+        # Transposed copy so each coordinate is its own contiguous array (the layout
+        # window_bbox was compiled for)
+        x1s, y1s, x2s, y2s = (np.asarray(boxes, dtype=np.int64).reshape(-1, 4) * scale).T.copy()
+        return texts, x1s, y1s, x2s - x1s, y2s - y1s
+
+    ocr_data = pytesseract.image_to_data(ocr_image, output_type=pytesseract.Output.DICT, lang='ces', config=TESSERACT_CONFIG)
+
+    # Filter out empty and low-confidence tokens with one vectorized mask
+    conf = np.asarray(ocr_data['conf'], dtype=np.float64).astype(np.int64)
+    stripped = np.char.strip(np.asarray(ocr_data['text'], dtype=str))
+    idx = np.flatnonzero((conf > 0) & (np.char.str_len(stripped) > 0))
+
+    texts = stripped[idx].tolist()
+    xs = np.asarray(ocr_data['left'], dtype=np.int64)[idx] * scale
+    ys = np.asarray(ocr_data['top'], dtype=np.int64)[idx] * scale
+    ws = np.asarray(ocr_data['width'], dtype=np.int64)[idx] * scale
+    hs = np.asarray(ocr_data['height'], dtype=np.int64)[idx] * scale
+    return texts, xs, ys, ws, hs
+
+@njit(cache=True)
+def window_bbox(xs, ys, ws, hs, i, length):
+    """Returns (min_x, min_y, max_x, max_y) of the words i .. i + length - 1."""
+    min_x = xs[i]
+    min_y = ys[i]
+    max_x = xs[i] + ws[i]
+    max_y = ys[i] + hs[i]
+    for k in range(i + 1, i + length):
+        min_x = min(min_x, xs[k])
+        min_y = min(min_y, ys[k])
+        max_x = max(max_x, xs[k] + ws[k])
+        max_y = max(max_y, ys[k] + hs[k])
+    return min_x, min_y, max_x, max_y
+
+# Compile the kernel at startup rather than on the first /solve
+_warmup = np.zeros(1, dtype=np.int64)
+window_bbox(_warmup, _warmup, _warmup, _warmup, 0, 1)
+
+def apply_region_offset(points):
+    """Shifts click points from screenshot space to screen space for region captures."""
+    offset_x = int(request.headers.get('X-Region-Left', 0))
+    offset_y = int(request.headers.get('X-Region-Top', 0))
+    if not offset_x and not offset_y:
+        return points
+    return [{**p, 'x': p['x'] + offset_x, 'y': p['y'] + offset_y} for p in points]
+
 def get_answers_from_gemini(image):
     """Fallback to Gemini to find answers in the image."""
-    if not GOOGLE_API_KEY:
+    if _GEMINI_MODEL is None:
         logging.error("Cannot use Gemini fallback: No API Key.")
         return []
     
     try:
         logging.info("Querying Gemini for answers...")
-        model = genai.GenerativeModel('gemini-2.0-flash')
         
         prompt = (
             "Analyze this image which contains a multiple-choice question. "
@@ -69,7 +265,7 @@ def get_answers_from_gemini(image):
             "Do not include any explanation or numbering."
         )
         
-        response = model.generate_content([prompt, image])
+        response = _GEMINI_MODEL.generate_content([prompt, image], request_options={'timeout': GEMINI_TIMEOUT})
         
         if response.text:
             answers = [line.strip() for line in response.text.split('\n') if line.strip()]
@@ -82,59 +278,73 @@ def get_answers_from_gemini(image):
 
 @app.route('/solve', methods=['POST'])
 def solve():
-    if 'image' not in request.files:
-        return jsonify({'error': 'No image part'}), 400
-    
-    file = request.files['image']
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+    # Local clients hand over the screenshot via shared memory and only POST its name
+    shm_payload = request.get_json(silent=True) if request.is_json else None
+    # Raw uploads carry unencoded pixels with the geometry in headers
+    raw_upload = request.mimetype == 'application/octet-stream'
+    if shm_payload is not None:
+        # Only a client on this machine may point the server at a shared memory block
+        if not is_local_request():
+            return jsonify({'error': 'Shared memory upload is only accepted from localhost'}), 400
+        if 'shm' not in shm_payload:
+            return jsonify({'error': 'No shared memory block'}), 400
+    elif raw_upload:
+        if 'X-Image-Width' not in request.headers or 'X-Image-Height' not in request.headers:
+            return jsonify({'error': 'Missing image size headers'}), 400
+    else:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image part'}), 400
+        
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
 
     try:
-        image = Image.open(file.stream)
+        if shm_payload is not None:
+            image = image_from_shared_memory(shm_payload)
+        elif raw_upload:
+            size = (int(request.headers['X-Image-Width']), int(request.headers['X-Image-Height']))
+            image = Image.frombytes(request.headers.get('X-Image-Mode', 'RGB'), size, request.get_data())
+        else:
+            image = Image.open(file.stream)
+
+        cache_key = image_cache_key(image)
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            logging.info("Identical screenshot seen before, returning cached result.")
+            return jsonify(apply_region_offset(cached))
         
         # 1. OCR processing
-        # Use local tessdata config via environment variable
-        cwd = os.getcwd()
-        local_tessdata = os.path.join(cwd, "tessdata")
-        if os.path.exists(os.path.join(local_tessdata, "ces.traineddata")):
-            os.environ["TESSDATA_PREFIX"] = local_tessdata
-        
-        ocr_data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT, lang='ces')
+        ocr_image, ocr_scale = preprocess_for_ocr(image)
         
-        # Build a list of valid words and their spatial info
-        valid_words = []
-        for i in range(len(ocr_data['text'])):
-            text = ocr_data['text'][i].strip()
-            if text and int(ocr_data['conf'][i]) > 0:
-                valid_words.append({
-                    'text': text,
-                    'x': ocr_data['left'][i],
-                    'y': ocr_data['top'][i],
-                    'w': ocr_data['width'][i],
-                    'h': ocr_data['height'][i]
-                })
+        # Valid words as parallel arrays (SoA): texts plus box geometry for cheap slicing
+        full_text_list, xs, ys, ws, hs = ocr_words(ocr_image, ocr_scale)
 
         # Reconstruct full text for searching, but keep track of indices
         # We join with spaces, so we need to account for that in mapping if we use indices
-        # Simplified: valid_words is our sequence.
-        full_text_list = [w['text'] for w in valid_words]
         full_text_str = " ".join(full_text_list)
+
+        # Offset of each word in full_text_str, to map substring hits back to word indices
+        word_starts = []
+        offset = 0
+        for text in full_text_list:
+            word_starts.append(offset)
+            offset += len(text) + 1
         
         logging.info(f"OCR extracted text length: {len(full_text_str)}")
 
         # 2. Find Question
-        question_texts = [q['text'] for q in QUESTIONS_DB]
-        match_result = process.extractOne(full_text_str, question_texts, scorer=fuzz.partial_ratio)
+        query_processed = utils.default_process(full_text_str)
+        match_result = process.extractOne(query_processed, QUESTION_TEXTS_PROCESSED, scorer=fuzz.partial_ratio, processor=None)
         
         best_match_q = None
         if match_result:
-            matched_text, score = match_result
+            # extractOne returns the index into the list, so map straight back to the question
+            _, score, match_idx = match_result
+            matched_text = QUESTIONS_DB[match_idx]['text']
             if score > 60: # Lower threshold to be safe, fuzzy match is powerful
                 logging.info(f"Found question match: '{matched_text[:30]}...' with score {score}")
-                for q in QUESTIONS_DB:
-                    if q['text'] == matched_text:
-                        best_match_q = q
-                        break
+                best_match_q = QUESTIONS_DB[match_idx]
             else:
                  logging.warning(f"Best match score too low: {score}")
 
@@ -151,63 +361,109 @@ def solve():
         # 3. Find Correct Answers (Logic merged above)
         logging.info(f"Looking for answers: {len(correct_answers)} found required.")
         
-        click_coordinates = []
-
         # 4. Locate Answers on Screen
         # Strategy: Search for the answer text within the full_text_str.
         # Use fuzzy search to find the *best matching substring* in the OCR text.
         # Then map that substring back to the list of words.
 
+        # Score windows in a narrow band around the answer's own word count, so a word that
+        # OCR split, merged or padded with a junk token still lines up with the real option
+        length_ranges = []
         for answer in correct_answers:
-            # We want to find where 'answer' appears in 'full_text_str'
-            # process.extractOne with the answer against segments of text could work,
-            # or simply fuzz.partial_ratio of answer vs full_text isn't enough to give location.
-            
+            target_len = max(1, len(answer.split()))
+            length_ranges.append((max(1, target_len - 1), target_len + 2))
+
+        # Build the sliding windows once per request and share them across all answers.
+        # Windows are generated length by length, so spans[:, 1] is sorted and every
+        # answer's [min_len, max_len] range is one contiguous slice.
+        windows = []
+        span_list = []
+        global_min = min(r[0] for r in length_ranges)
+        global_max = max(r[1] for r in length_ranges)
+        for length in range(global_min, global_max + 1):
+            for i in range(len(full_text_list) - length + 1):
+                windows.append(" ".join(full_text_list[i : i + length]))
+                span_list.append((i, length))
+        spans = np.asarray(span_list, dtype=np.int64).reshape(-1, 2)
+        window_chars = np.fromiter((len(t) for t in windows), dtype=np.int64, count=len(windows))
+
+        def locate_answer(answer, length_range):
+            """Returns the click point for one answer, or None if it isn't on screen."""
+            min_len, max_len = length_range
             # Use a sliding window of words to find the best match for this answer
-            target_len = len(answer.split())
             best_window_score = 0
             best_window_idx = -1
             best_window_len = 0
-            
-            # We assume the answer in OCR might have +/- a few words
-            # Widen the search window significantly to handle OCR fragmentation or checking
-            min_len = max(1, int(target_len * 0.6))
-            max_len = int(target_len * 2.0) + 2
-            
             best_candidate_text = ""
 
-            # Optimization: only scan windows if we have enough words
-            if len(valid_words) >= min_len:
-                for length in range(min_len, max_len + 1):
-                    for i in range(len(valid_words) - length + 1):
-                        window_text = " ".join([w['text'] for w in valid_words[i : i + length]])
-                        score = fuzz.ratio(answer, window_text)
-                        
-                        if score > best_window_score:
-                            best_window_score = score
-                            best_window_idx = i
-                            best_window_len = length
-                            best_candidate_text = window_text
+            # Fast path: the answer appears verbatim in the OCR text, so no fuzzy scan is needed.
+            # Only hits that start and end on word boundaries count, otherwise a short answer
+            # like "16" would match inside e.g. "130.17.16.15/16?" in the question.
+            pos = full_text_str.find(answer) if answer else -1
+            while pos >= 0:
+                first_word_idx = bisect_right(word_starts, pos) - 1
+                last_word_idx = bisect_right(word_starts, pos + len(answer) - 1) - 1
+                end = word_starts[last_word_idx] + len(full_text_list[last_word_idx])
+                if pos == word_starts[first_word_idx] and pos + len(answer) == end:
+                    break
+                pos = full_text_str.find(answer, pos + 1)
+
+            if pos >= 0:
+                best_window_idx = first_word_idx
+                best_window_len = last_word_idx - first_word_idx + 1
+                best_window_score = 100
+            else:
+                lo, hi = np.searchsorted(spans[:, 1], [min_len, max_len + 1])
+
+                # fuzz.ratio can never exceed 100 * (1 - |la - lw| / (la + lw)), so windows whose
+                # character length alone rules out beating the threshold are dropped up front
+                len_a = len(answer)
+                lw = window_chars[lo:hi]
+                upper_bound = 100.0 * (1.0 - np.abs(lw - len_a) / np.maximum(lw + len_a, 1))
+                candidates = lo + np.flatnonzero(upper_bound > ANSWER_MATCH_THRESHOLD)
+
+                if len(candidates):
+                    # Score every remaining window in a single native cdist call; with score_cutoff
+                    # RapidFuzz abandons a comparison as soon as it can't reach the threshold
+                    # (those windows score 0)
+                    scores = process.cdist([answer], [windows[k] for k in candidates], scorer=fuzz.ratio,
+                                           score_cutoff=ANSWER_MATCH_THRESHOLD, workers=1)[0]
+                    if scores.max() > 0:
+                        best = int(candidates[scores.argmax()])
+                        best_window_score = float(scores.max())
+                        best_window_idx, best_window_len = (int(v) for v in spans[best])
+                        best_candidate_text = windows[best]
             
-            if best_window_score > 65: # Good confidence match (slightly lowered)
-                # Calculate center of this block
-                words_in_window = valid_words[best_window_idx : best_window_idx + best_window_len]
-                
+            if best_window_score > ANSWER_MATCH_THRESHOLD: # Good confidence match (slightly lowered)
                 # Bounding box of the phrase
-                min_x = min(w['x'] for w in words_in_window)
-                min_y = min(w['y'] for w in words_in_window)
-                max_x = max(w['x'] + w['w'] for w in words_in_window)
-                max_y = max(w['y'] + w['h'] for w in words_in_window)
+                min_x, min_y, max_x, max_y = (int(v) for v in window_bbox(xs, ys, ws, hs, best_window_idx, best_window_len))
                 
                 center_x = min_x + (max_x - min_x) // 2
                 center_y = min_y + (max_y - min_y) // 2
                 
-                click_coordinates.append({"x": center_x, "y": center_y, "text": answer})
                 logging.info(f"Found answer: '{answer}' at {center_x}, {center_y} (Score: {best_window_score})")
-            else:
-                logging.warning(f"Could not find answer on screen: '{answer[:20]}...' Best score: {best_window_score} for '{best_candidate_text[:30]}...'")
+                return {"x": center_x, "y": center_y, "text": answer}
+
+            # score_cutoff zeroes every sub-threshold window, so rescore this answer's windows
+            # without it to log the closest candidate
+            lo, hi = np.searchsorted(spans[:, 1], [min_len, max_len + 1])
+            if hi > lo:
+                best_candidate_text, best_window_score, _ = process.extractOne(answer, windows[lo:hi], scorer=fuzz.ratio)
+            logging.warning(f"Could not find answer on screen: '{answer[:20]}...' Best score: {best_window_score} for '{best_candidate_text[:30]}...'")
+            return None
+
+        # Answers are independent and RapidFuzz releases the GIL while scoring, so search
+        # for them in parallel (cdist stays single-threaded inside each worker)
+        with ThreadPoolExecutor(max_workers=min(len(correct_answers), os.cpu_count() or 1)) as ex:
+            results = list(ex.map(locate_answer, correct_answers, length_ranges))
+        click_coordinates = [point for point in results if point is not None]
 
-        return jsonify(click_coordinates)
+        # Cache coordinates relative to the screenshot; the region offset is per request.
+        # Only DB hits that located something are cached: an empty result or a Gemini
+        # answer should be retried when the user clicks again on the same screen.
+        if click_coordinates and best_match_q:
+            store_cached_result(cache_key, click_coordinates)
+        return jsonify(apply_region_offset(click_coordinates))
 
     except Exception as e:
         logging.error(f"Error processing image: {e}")
@@ -216,5 +472,7 @@ def solve():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    # Threaded=True for handling multiple requests (though client is single user)
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Production WSGI server instead of Werkzeug's debug server (no reloader, real
+    # worker threads); waitress runs on Windows as well
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=5000, threads=4)